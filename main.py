@@ -1,63 +1,209 @@
-import glob
-import os
-import re
 import io
-import mmap
-import shutil
+import os
+import csv
+import tempfile
 import argparse
+import contextlib
+import itertools
 import tracemalloc
-import numpy as np
-import pandas as pd
-import multiprocessing
-from functools import reduce
-from time import process_time
+import collections
+import ahocorasick
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
 
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
-# from memory_profiler import profile
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
 
 
-# @profile
-def gunzip_fastq(file):
-    import gzip
-    import shutil
+# line-by-line memory profiling slows every call down, so it is enabled only on demand
+# and only for coarse steps which run once per script, never for calls made per chunk
+if os.getenv('MEMPROFILE'):
+    from memory_profiler import profile
+else:
+    def profile(func):
+        return func
+
+
+CHUNK_SIZE = 1 << 24
+CHUNK_READS = 1 << 16
+
+
+def is_seekable_fastq(file_path):
+    # gzipped reads can be read from any offset only with indexed_gzip
+    return file_path[-3:] != '.gz' or indexed_gzip is not None
+
+
+@profile
+def build_gzip_index(file_path, index_paths):
+    # reuse a fresh index or build it once and save to the first writable path,
+    # None means no path was writable and every reader builds the index itself
+    for index_path in index_paths:
+        if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(file_path):
+            return index_path
+    with indexed_gzip.IndexedGzipFile(file_path) as in_f:
+        in_f.build_full_index()
+        for index_path in index_paths:
+            # unique name and atomic rename, so that concurrent runs never read a partial index
+            tmp_path = f'{index_path}.{os.getpid()}.tmp'
+            try:
+                in_f.export_index(tmp_path)
+                os.replace(tmp_path, index_path)
+                return index_path
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return None
 
-    with gzip.open(file, 'rb') as in_f:
-        with open(file.replace('.gz', ''), 'wb') as out_f:
-            shutil.copyfileobj(in_f, out_f)
+
+def open_fastq(file_path, index_file=None):
+    # gzipped reads are unpacked on the fly, without writing them to disk
+    if file_path[-3:] == '.gz' and indexed_gzip is not None:
+        in_f = indexed_gzip.IndexedGzipFile(file_path, index_file=index_file, drop_handles=False)
+    elif file_path[-3:] == '.gz':
+        in_f = gzip.open(file_path, 'rb')
+    else:
+        in_f = open(file_path, 'rb', buffering=1 << 20)
+    # file is read strictly forward, so let the kernel read ahead aggressively
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(in_f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return in_f
 
 
-# @profile
 def get_nucleotides_from_fq(file_path):
-    file_size = os.path.getsize(file_path)
-    with open(file_path, "r+b") as f:
-        map_file = mmap.mmap(f.fileno(), length=file_size, access=mmap.ACCESS_READ)
-        return [line for line in iter(map_file.readline, b"")][1::4]
+    # stream every fourth line starting from the second, islice drops other lines in C as they are read
+    with open_fastq(file_path) as in_f:
+        yield from itertools.islice(in_f, 1, None, 4)
+
+
+def get_nucleotide_chunks(file_path, chunk_reads=CHUNK_READS):
+    # join sequence lines of many reads in C, so that consumers handle whole chunks instead of single reads
+    sequences = get_nucleotides_from_fq(file_path)
+    yield from iter(lambda: b''.join(itertools.islice(sequences, chunk_reads)), b'')
+
+
+def find_record_start(in_f, offset, block_size=1 << 16):
+    # record starts with '@' after a line end and has '+' line two lines below,
+    # quality line starting with '@' has a sequence two lines below instead
+    if offset == 0:
+        return 0
+    in_f.seek(offset - 1)
+    block, pos, more = b'', 0, True
+    while more:
+        more = in_f.read(block_size)
+        block += more
+        while True:
+            pos = block.find(b'\n@', pos)
+            if pos == -1:
+                pos = max(len(block) - 1, 0)
+                break
+            header_end = block.find(b'\n', pos + 1)
+            sequence_end = block.find(b'\n', header_end + 1) if header_end != -1 else -1
+            if sequence_end == -1 or sequence_end + 1 == len(block):
+                break
+            if block[sequence_end + 1:sequence_end + 2] == b'+':
+                return offset + pos
+            pos += 1
+    return offset - 1 + len(block)
+
+
+@profile
+def get_fastq_bounds(in_f, chunk_size=CHUNK_SIZE):
+    # cut FASTQ on record starts so that every chunk holds whole records
+    file_size = in_f.seek(0, os.SEEK_END)
+    starts = sorted({find_record_start(in_f, offset) for offset in range(0, file_size, chunk_size)})
+    return [(start, end) for start, end in zip(starts, starts[1:] + [file_size]) if start < end]
+
+
+@profile
+def get_guides_from_file(file_path):
+    # every unique guide is searched once, its occurence goes to all genes and exones sharing it
+    guides_dict = collections.defaultdict(list)
+    with open(file_path, newline='') as in_f:
+        for row in csv.DictReader(in_f, delimiter='\t'):
+            entry = (row['GENES'], row['EXONE'])
+            if entry not in guides_dict[row['CODE']]:
+                guides_dict[row['CODE']].append(entry)
+    return dict(guides_dict)
 
 
-# @profile
-def get_guides_from_file(df):
-    return dict(zip(df.CODE, zip(df.GENES, df.EXONE)))
+def build_automaton(guides):
+    automaton = ahocorasick.Automaton()
+    for guide in guides:
+        automaton.add_word(guide, guide)
+    automaton.make_automaton()
+    return automaton
 
 
-# @profile
-def mmap_grep_calc(pattern, file_path):
-    pattern = pattern.encode('utf-8')
-    with io.open(file_path, 'r', encoding='utf-8') as f:
-        file_size = os.path.getsize(file_path)
-        mmap_file = mmap.mmap(f.fileno(), file_size, access=mmap.ACCESS_READ)
-        return len(re.findall(pattern, mmap_file))
+def count_guides_in_chunk(chunk, automaton):
+    # all guides are matched in a single pass over the chunk, overlapping hits are counted too
+    counts = collections.Counter()
+    # automaton without guides is never built and cannot be iterated
+    if len(automaton) == 0:
+        return counts
+    for _, key in automaton.iter(chunk.decode('ascii')):
+        counts[key] += 1
+    return counts
 
 
-# @profile
-def compute_results(i, nucl_f, guides_dict, tmp_folder):
-    with open(f'{tmp_folder}/df_{i}.out', 'w') as out_f:
-        out_f.write('gene\texone\toccurence\n')
-        for guide in guides_dict:
-            gene = guides_dict[guide][0]
-            exone = guides_dict[guide][1]
-            occurence = mmap_grep_calc(guide, nucl_f)
-            result = f'{gene}\t{exone}\t{occurence}\n'
-            out_f.write(result)
+# FASTQ file and guides automaton shared by every worker process
+worker_fastq = None
+worker_automaton = None
+
+
+def init_worker(guides):
+    global worker_automaton
+    worker_automaton = build_automaton(guides)
+
+
+def compute_results(chunk):
+    return count_guides_in_chunk(chunk, worker_automaton)
+
+
+def init_fastq_worker(file_path, index_file, guides):
+    global worker_fastq
+    worker_fastq = open_fastq(file_path, index_file)
+    init_worker(guides)
+
+
+def compute_fastq_results(bounds):
+    # every worker unpacks and parses its own records of FASTQ
+    start, end = bounds
+    worker_fastq.seek(start)
+    records = io.BytesIO(worker_fastq.read(end - start))
+    return count_guides_in_chunk(b''.join(itertools.islice(records, 1, None, 4)), worker_automaton)
+
+
+@profile
+def run_workers(compute, tasks, initializer, initargs):
+    # only a few tasks wait in the queue, so chunks are read while workers count the previous ones
+    counts = collections.Counter()
+    max_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs) as executor:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(executor.submit(compute, task))
+            if len(pending) > 2 * max_workers:
+                counts.update(pending.popleft().result())
+        for future in pending:
+            counts.update(future.result())
+    return counts
+
+
+@profile
+def summarize_counts(counts, guides_dict):
+    # sum occurences of guides which belong to the same gene and exone
+    results = collections.Counter()
+    for guide, entries in guides_dict.items():
+        for gene, exone in entries:
+            results[(gene, exone)] += counts.get(guide, 0)
+    return results
 
 
 if __name__ == '__main__':
@@ -66,79 +212,60 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--fastq', type=str, help='Path to input FAStQ file')
     parser.add_argument('-t', '--tsv', type=str, help='Path to input TSV file')
     parser.add_argument('-o', '--output', type=str, help='Path to output file')
-    parser.add_argument('--tmp', type=str, nargs='?', default='tmp_files', help='Path to folder with temporary files')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print time and memory usage of every step')
     args = parser.parse_args()
 
-    tracemalloc.start()
-    start_time = process_time()
+    if args.verbose:
+        tracemalloc.start()
+    # wall-clock time, because most of the work runs in worker processes
+    start_time = perf_counter()
 
-    # check if file gzipped or not
-    if args.fastq[-3:] == 'gz':
-        gunzip_fastq(args.fastq)
-        print("Input reads are unpacked.")
-        args.fastq = args.fastq[:-3]
-    else:
-        print("Input file is recognized as unpacked.")
+    output_name = args.output
 
-    # check if tmp folder exists (create or overwrite)
-    if os.path.exists(args.tmp):
-        print("Temporary directory exists! Overwriting...")
-        shutil.rmtree(args.tmp)
-        os.mkdir(args.tmp)
-    else:
-        os.mkdir(args.tmp)
-        print("Make temporary directory.")
-
-    print("Read FastQ file...")
-    # write nucleotides in several files for reading only them in mmap
-    sequences = get_nucleotides_from_fq(args.fastq)
-    print("Writing nucleotides in tmp files...")
-    number_of_files = 4
-    sequences_split = np.array_split(sequences, number_of_files)
-    for i, part in enumerate(sequences_split):
-        with open(f'{args.tmp}/nucleotides_{i}.fa', 'wb') as nucl_f:
-            nucl_f.write(b''.join(part))
-    print("--- %s seconds for parse FastQ file ---" % (process_time() - start_time))
-
-    guides_data = pd.read_csv(args.tsv, sep="\t")
+    dict_time = perf_counter()
+    guides_dict = get_guides_from_file(args.tsv)
+    if args.verbose:
+        print("--- %s seconds for parse guide file ---" % (perf_counter() - dict_time))
 
-    output_name = args.output
+    # tmp dir with gzip index lives until all workers are done, and is removed on errors too
+    with contextlib.ExitStack() as stack:
+        split_time = perf_counter()
+        if is_seekable_fastq(args.fastq):
+            # workers read their own chunks of FASTQ, gzipped reads are unpacked in parallel
+            print("Split FastQ file into chunks...")
+            # index is kept near the reads for the next runs, or in a tmp dir for this run if that is read-only
+            index_file = None
+            if args.fastq[-3:] == '.gz':
+                index_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                index_file = build_gzip_index(args.fastq, [args.fastq + '.gzidx', os.path.join(index_dir, 'reads.gzidx')])
+            with open_fastq(args.fastq, index_file) as fastq_f:
+                tasks = get_fastq_bounds(fastq_f)
+            compute, initializer = compute_fastq_results, init_fastq_worker
+            initargs = (args.fastq, index_file, list(guides_dict))
+            if args.verbose:
+                print("--- %s seconds for split FastQ file ---" % (perf_counter() - split_time))
+        else:
+            print("Input reads are recognized as gzipped, unpack them while reading.")
+            # nucleotides of many reads go to workers in chunks, reads stay separated by line ends
+            tasks = get_nucleotide_chunks(args.fastq)
+            compute, initializer, initargs = compute_results, init_worker, (list(guides_dict),)
+
+        # read FASTQ chunks and count guides in them by all processes
+        grep_time = perf_counter()
+        counts = run_workers(compute, tasks, initializer, initargs)
+
+    rows = [(gene, exone, occurence) for (gene, exone), occurence in summarize_counts(counts, guides_dict).items()]
+    with open(args.output, 'w', newline='', buffering=1 << 20) as out_f:
+        writer = csv.writer(out_f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['gene', 'exone', 'occurence'])
+        writer.writerows(rows)
+
+    if args.verbose:
+        print("--- %s seconds for read FastQ file and grep guide data ---" % (perf_counter() - grep_time))
+        print("--- %s seconds for whole main script ---" % (perf_counter() - start_time))
 
-    dict_time = process_time()
-    guides_dict = get_guides_from_file(guides_data)
-    print("--- %s seconds for parse guide file ---" % (process_time() - dict_time))
-
-    # process four separate nucleotide files and write to tmp dfs
-    p = multiprocessing.Pool()
-    grep_time = process_time()
-    for i, nucl_f in enumerate(glob.glob(f'{args.tmp}/*.fa')):
-        compute_results(i, nucl_f, guides_dict, args.tmp)
-        p.apply_async(compute_results, [nucl_f])
-    p.close()
-    p.join()
-
-    # summarize dfs
-    with open(args.output, 'w') as out_f:
-        dfs = list()
-        for file in glob.glob(f'{args.tmp}/*.out'):
-            # read with two index cols for suitable sum
-            df = pd.read_csv(file, sep='\t', index_col=[0, 1])
-            dfs.append(df)
-        # string for sum multiple dfs
-        dfs_sum = reduce(lambda df1, df2: df1.add(df2, fill_value=0),
-                         dfs)
-        dfs_sum.reset_index(level=1, inplace=True)
-        dfs_sum.to_csv(out_f, sep='\t', line_terminator='\n')
-
-    print("--- %s seconds for grep guide data ---" % (process_time() - grep_time))
-
-    print("Remove temporary files and directory...")
-    shutil.rmtree(args.tmp)
-
-    print("--- %s seconds for whole main script ---" % (process_time() - start_time))
-
-    current, peak = tracemalloc.get_traced_memory()
-    print(f'Current memory usage is {current / 10 ** 6}MB; Peak was {peak / 10 ** 6}MB')
-    tracemalloc.stop()
+        current, peak = tracemalloc.get_traced_memory()
+        print(f'Current memory usage is {current / 10 ** 6}MB; Peak was {peak / 10 ** 6}MB')
+        tracemalloc.stop()
 
     print("Done. Thank you.")
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import main
 
@@ -18,4 +20,61 @@ class MainCodeTest(unittest.TestCase):
         occurence = 2
         simple_nucl_file = 'test_data/test_my_grep_calc_1.txt'
         test_pattern = "ATGCACA"
-        self.assertEqual(main.mmap_grep_calc(test_pattern, simple_nucl_file), occurence)
+        with open(simple_nucl_file, 'rb') as nucl_f:
+            nucleotides = nucl_f.read()
+        automaton = main.build_automaton([test_pattern])
+        self.assertEqual(main.count_guides_in_chunk(nucleotides, automaton)[test_pattern], occurence)
+
+    def test_count_guides_in_chunk(self):
+        simple_nucl_file = 'test_data/test_my_grep_calc_1.txt'
+        with open(simple_nucl_file, 'rb') as nucl_f:
+            nucleotides = nucl_f.read()
+        # overlapping hits and guides with N are counted
+        occurences = {"ACA": 5, "ATGCACA": 2, "TGNT": 1, "ACAA": 1}
+        automaton = main.build_automaton(list(occurences))
+        self.assertEqual(main.count_guides_in_chunk(nucleotides, automaton), occurences)
+
+    def test_count_guides_in_chunk_without_guides(self):
+        automaton = main.build_automaton([])
+        self.assertEqual(main.count_guides_in_chunk(b'ACGT\n', automaton), {})
+
+    def test_get_nucleotides_from_gzipped_fastq(self):
+        simple_fastq = 'test_data/test_get_nucleotides_from_fastq.txt'
+        self.assertEqual(list(main.get_nucleotides_from_fq(simple_fastq + '.gz')),
+                         list(main.get_nucleotides_from_fq(simple_fastq)))
+
+    @unittest.skipIf(main.indexed_gzip is None, "indexed_gzip is not installed")
+    def test_build_gzip_index(self):
+        simple_fastq = 'test_data/test_get_nucleotides_from_fastq.txt'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # index falls back to the next path when the first one is not writable
+            index_paths = [os.path.join(tmp_dir, 'missing', 'reads.gzidx'), os.path.join(tmp_dir, 'reads.gzidx')]
+            index_file = main.build_gzip_index(simple_fastq + '.gz', index_paths)
+            self.assertEqual(index_file, index_paths[1])
+            self.assertEqual(os.listdir(tmp_dir), ['reads.gzidx'])
+            with main.open_fastq(simple_fastq + '.gz', index_file) as gz_f, open(simple_fastq, 'rb') as in_f:
+                self.assertEqual(gz_f.read(), in_f.read())
+
+    def test_get_fastq_bounds(self):
+        simple_fastq = 'test_data/test.fq'
+        sequences = list()
+        with open(simple_fastq, 'rb') as in_f:
+            for start, end in main.get_fastq_bounds(in_f, chunk_size=1000):
+                in_f.seek(start)
+                sequences.extend(in_f.read(end - start).splitlines(keepends=True)[1::4])
+        self.assertEqual(sequences, list(main.get_nucleotides_from_fq(simple_fastq)))
+
+    def test_get_nucleotide_chunks(self):
+        simple_fastq = 'test_data/test.fq'
+        chunks = list(main.get_nucleotide_chunks(simple_fastq, chunk_reads=1000))
+        self.assertEqual(len(chunks), 12)
+        self.assertEqual(b''.join(chunks), b''.join(main.get_nucleotides_from_fq(simple_fastq)))
+
+    def test_get_guides_from_file(self):
+        guides_dict = main.get_guides_from_file('test_data/test_duplicated_guides.tsv')
+        self.assertEqual(guides_dict, {"TTTGGGAGTGACCTTCAGA": [("My_gene_F1", "My_exone_F1"), ("My_gene_F5", "My_exone_F5")],
+                                       "GTAGAATCCAGCCTAGAAT": [("My_gene_F3", "My_exone_F3")]})
+        # occurence of shared guide goes to every gene and exone
+        results = main.summarize_counts({"TTTGGGAGTGACCTTCAGA": 4}, guides_dict)
+        self.assertEqual(results, {("My_gene_F1", "My_exone_F1"): 4, ("My_gene_F5", "My_exone_F5"): 4,
+                                   ("My_gene_F3", "My_exone_F3"): 0})